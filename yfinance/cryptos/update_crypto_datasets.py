@@ -4,12 +4,19 @@
 # pip install --upgrade yfinance
 
 import os
-import json
-import yfinance as yf
+import sys
+# Un hilo por proceso en las librerías numéricas: el paralelismo lo dan los procesos
+os.environ.setdefault("OMP_NUM_THREADS", "1")
 import pandas as pd
-from datetime import timedelta
 
-class UnifiedDataDownloader:
+# El motor de descarga común (yahoo_batch.py) está en el directorio yfinance/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yahoo_batch import (INTERVAL_CONFIG, INTRADAY_INTERVALS, SAVE_PARQUET, CsvWriter, YahooBatchDownloader,
+                         atomic_write, concat_frames, fast_ohlcv_to_csv, parse_csv_dates, read_last_timestamp,
+                         read_tickers, write_parquet)
+
+
+class UnifiedDataDownloader(CsvWriter):
     """
     Clase unificada para descargar datos tanto históricos (no intradiarios) como intradiarios usando yfinance.
 
@@ -19,32 +26,25 @@ class UnifiedDataDownloader:
         descarga en bloques (chunks) debido a las limitaciones de yfinance.
     """
 
-    def __init__(self, ticker, output_dir):
+    # Definir los intervalos intradiarios reconocidos
+    intraday_intervals = INTRADAY_INTERVALS
+
+    def __init__(self, ticker, output_dir, save_csv=True):
         """
         :param ticker: Símbolo del activo, por ejemplo "BTC-USD".
         :param output_dir: Directorio donde se guardarán los archivos CSV.
+        :param save_csv: Si False, save no escribe nada y devuelve los datos descargados.
         """
-        self.ticker = ticker
-        self.output_dir = output_dir
-        os.makedirs(self.output_dir, exist_ok=True)
-        # Definir los intervalos intradiarios reconocidos
-        self.intraday_intervals = {"1m", "2m", "5m", "15m", "30m", "60m", "90m", "1h"}
+        super().__init__(ticker, output_dir)
+        self.save_csv = save_csv
 
     def flatten_columns(self, df):
         """
-        Aplana las columnas del DataFrame en caso de MultiIndex o columnas que sean tuplas.
+        Aplana las columnas del DataFrame en caso de MultiIndex (pandas construye un
+        MultiIndex siempre que las columnas son tuplas), quedándose con el primer nivel.
         """
         if isinstance(df.columns, pd.MultiIndex):
             df.columns = df.columns.get_level_values(0)
-        else:
-            # En caso de que alguna columna sea una tupla
-            new_columns = []
-            for col in df.columns:
-                if isinstance(col, tuple):
-                    new_columns.append(col[0])
-                else:
-                    new_columns.append(col)
-            df.columns = new_columns
         return df
 
     def unify_columns(self, df):
@@ -87,6 +87,183 @@ class UnifiedDataDownloader:
 
         return df
 
+    def load_csv(self, interval):
+        """
+        Lee el CSV guardado de un intervalo con las fechas ya convertidas.
+
+        :return: DataFrame con los datos unificados, vacío si no hay CSV.
+        """
+        filename = self.csv_path(interval)
+        if not os.path.isfile(filename):
+            return pd.DataFrame()
+        df = pd.read_csv(filename)
+        df["datetime"] = parse_csv_dates(df["datetime"])
+        return self.downcast_columns(df)
+
+    def incremental_start(self, interval):
+        """
+        Como CsvWriter.incremental_start, pero sin guardar en CSV (save_csv=False) se
+        descarga siempre la ventana completa.
+        """
+        if not self.save_csv:
+            return None
+        return super().incremental_start(interval)
+
+    def prepare_intraday(self, df):
+        """
+        Convierte un bloque intradiario descargado (con el índice temporal) al formato unificado.
+        """
+        df = self.flatten_columns(df)
+        # Nombrar el índice directamente como "datetime" evita renombrar la columna después
+        df = df.rename_axis("datetime").reset_index()
+        return self.downcast_columns(self.unify_columns(df))
+
+    def downcast_columns(self, df):
+        """
+        Reduce el tamaño de la columna de volumen al entero sin signo más pequeño que admite
+        sus valores. Los precios se mantienen en float64: en float32 se perderían decimales
+        en activos de precio alto (p. ej. los céntimos de BTC).
+        """
+        if "volume" in df.columns and pd.api.types.is_integer_dtype(df["volume"]):
+            df = df.assign(volume=pd.to_numeric(df["volume"], downcast="unsigned"))
+        return df
+
+    @staticmethod
+    def drop_overlap(data_frames, last_ts=None):
+        """
+        Descarta de una secuencia de bloques en orden cronológico las filas que no son
+        posteriores a la última fecha ya vista. Los bloques son contiguos y están ordenados,
+        así que los duplicados solo aparecen en sus fronteras y basta con esa comparación.
+
+        :param data_frames: Iterable de DataFrames (ya unificados) con la fecha en la primera columna.
+        :param last_ts: Última fecha ya guardada, o None si no hay datos previos.
+        :return: Generador de DataFrames no vacíos con solo las filas nuevas.
+        """
+        for df in data_frames:
+            if last_ts is not None:
+                df = df[df.iloc[:, 0].values > pd.Timestamp(last_ts).to_datetime64()]
+            if df.empty:
+                continue
+            last_ts = df.iloc[-1, 0]
+            yield df
+
+    def save_intraday(self, interval, data_frames):
+        """
+        Escribe los bloques intradiarios directamente en el CSV, a medida que llegan.
+        Si el CSV ya existe, los datos nuevos se añaden al final.
+
+        Si SAVE_PARQUET está activo, cada bloque se guarda además como un fichero Parquet
+        dentro del directorio "<ticker>_<intervalo>.parquet", legible como un único
+        dataset con pq.ParquetDataset o pd.read_parquet.
+
+        :param interval: Intervalo de los datos, ej: "1m".
+        :param data_frames: Iterable de DataFrames (ya unificados) en orden cronológico.
+        :return: Número de filas nuevas escritas.
+        :raises ValueError: Si el CSV existe pero no se puede leer su última fecha.
+        """
+        filename = self.csv_path(interval)
+        # El CSV existente está ordenado: basta con su última fecha para descartar lo ya guardado
+        # Sin ella no se sabe qué filas son nuevas: el error se propaga sin tocar el fichero
+        last_ts = read_last_timestamp(filename)
+        # Un CSV existente nunca se reescribe: como mucho se le añaden filas
+        mode = "a" if os.path.exists(filename) else "w"
+        header = mode == "w" or os.path.getsize(filename) == 0
+        if last_ts is not None:
+            print(f"El archivo {filename} ya existe. Añadiendo los datos posteriores a {last_ts}...")
+
+        parquet_dir = os.path.join(self.output_dir, f"{self.ticker}_{interval}.parquet")
+        if SAVE_PARQUET:
+            os.makedirs(parquet_dir, exist_ok=True)
+            if last_ts is None:
+                # El CSV no tiene filas de datos: descartar los bloques Parquet anteriores
+                with os.scandir(parquet_dir) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".parquet"):
+                            os.remove(entry.path)
+
+        # Un CSV nuevo se escribe en un temporal y se mueve a su sitio al terminar. Al añadir
+        # a uno existente, si algo falla se recorta a su tamaño original, de modo que nunca
+        # queda una fila a medias
+        size = os.path.getsize(filename) if mode == "a" else 0
+        opener = open if mode == "a" else atomic_write
+
+        new_rows = 0
+        try:
+            with opener(filename, mode, buffering=1 << 20, newline="\n") as fh:
+                # Cada bloque se escribe y se descarta: solo se cuentan sus filas
+                for df in self.drop_overlap(data_frames, last_ts):
+                    fast_ohlcv_to_csv(df, fh, header=header)
+                    if SAVE_PARQUET:
+                        write_parquet(df, os.path.join(parquet_dir, f"part-{df.iloc[0, 0]:%Y%m%d%H%M%S}.parquet"))
+                    header = False
+                    new_rows += len(df)
+        except BaseException:
+            if mode == "a":
+                os.truncate(filename, size)
+            raise
+
+        if new_rows:
+            print(f"Datos guardados/acumulados en: {filename} ({new_rows} filas nuevas)")
+        else:
+            print(f"No se han descargado datos intradiarios nuevos para {self.ticker} | intervalo {interval}.")
+        return new_rows
+
+    def save_historical(self, interval, df, save_csv=True):
+        """
+        Convierte los datos históricos (no intradiarios) al formato unificado y los guarda.
+
+        :param interval: Intervalo de los datos, ej: "1d".
+        :param df: DataFrame descargado con el índice temporal.
+        :param save_csv: Si True, guarda los datos en un archivo CSV.
+        :return: DataFrame con los datos unificados.
+        """
+        if df.empty:
+            print(f"  No se han obtenido datos para {self.ticker} en el intervalo {interval}.")
+            return pd.DataFrame()
+
+        df = self.flatten_columns(df)
+        df = df.rename_axis("datetime").reset_index()
+        # Renombrar columnas para unificar
+        df.rename(columns={
+            "Open": "open",
+            "High": "high",
+            "Low": "low",
+            "Close": "close",
+            "Volume": "volume"
+        }, inplace=True)
+        if "Adj Close" in df.columns:
+            df.drop(columns=["Adj Close"], inplace=True)
+        df["datetime"] = pd.to_datetime(df["datetime"])
+        df = self.downcast_columns(df[["datetime", "open", "high", "low", "close", "volume"]])
+
+        if save_csv:
+            filename = self.csv_path(interval)
+            with atomic_write(filename, "w", buffering=1 << 20, newline="\n") as fh:
+                fast_ohlcv_to_csv(df, fh)
+            if SAVE_PARQUET:
+                write_parquet(df, os.path.join(self.output_dir, f"{self.ticker}_{interval}.parquet"))
+            print(f"  Datos guardados en: {filename}")
+
+        return df
+
+    def save(self, interval, data_frames):
+        """
+        Guarda los datos de un intervalo tal y como los entrega YahooBatchDownloader.
+
+        :param interval: Intervalo de los datos, ej: "1m", "1d".
+        :param data_frames: Lista de DataFrames del ticker tal y como se descargaron
+                            (un bloque por elemento; un único elemento para históricos).
+        :return: Número de filas escritas o, con save_csv=False, DataFrame con los datos unificados.
+        """
+        if interval in self.intraday_intervals:
+            data_frames = (self.prepare_intraday(df) for df in data_frames)
+            if not self.save_csv:
+                return self.downcast_columns(concat_frames(self.drop_overlap(data_frames)))
+            return self.save_intraday(interval, data_frames)
+        df = self.save_historical(interval, data_frames[0] if data_frames else pd.DataFrame(),
+                                  save_csv=self.save_csv)
+        return len(df) if self.save_csv else df
+
     def download_interval(self, interval, save_csv=True, historical_days=None, chunk_days=None):
         """
         Descarga datos para un intervalo específico.
@@ -95,117 +272,15 @@ class UnifiedDataDownloader:
         :param save_csv: Si True, guarda los datos en un archivo CSV.
         :param historical_days: (Para datos intradiarios) Número total de días históricos a descargar.
         :param chunk_days: (Para datos intradiarios) Número de días por bloque de descarga.
-        :return: DataFrame con los datos descargados.
+        :return: DataFrame con los datos descargados. Con save_csv=True se devuelve el CSV completo.
         """
-        if interval in self.intraday_intervals:
-            # ----- Datos intradiarios -----
-            # Definir valores por defecto si no se especifican
-            if historical_days is None:
-                if interval in ['1m', '2m', '5m', '15m', '30m']:
-                    historical_days = 30
-                elif interval in ['60m', '1h']:
-                    historical_days = 90
-                elif interval == '90m':
-                    historical_days = 60
-                else:
-                    historical_days = 30
-            if chunk_days is None:
-                chunk_days = 8 if interval == '1m' else 15
-
-            now = pd.Timestamp.now()
-            end_date = now
-            start_date = now - timedelta(days=historical_days) + timedelta(days=1)
-            max_chunk = timedelta(days=chunk_days)
-
-            data_frames = []
-            current_start = start_date
-            while current_start < end_date:
-                current_end = min(current_start + max_chunk, end_date)
-                print(f"Descargando datos intradiarios de {current_start.date()} a {current_end.date()} para {self.ticker} | intervalo {interval}")
-                try:
-                    df = yf.download(
-                        self.ticker,
-                        start=current_start.strftime("%Y-%m-%d"),
-                        end=current_end.strftime("%Y-%m-%d"),
-                        interval=interval,
-                        progress=False
-                    )
-                    if not df.empty:
-                        df.reset_index(inplace=True)
-                        df = self.flatten_columns(df)
-                        df = self.unify_columns(df)
-                        data_frames.append(df)
-                    else:
-                        print("  No se obtuvieron datos en este periodo.")
-                except Exception as e:
-                    print(f"  Error descargando datos de {current_start.date()} a {current_end.date()}: {e}")
-                current_start = current_end
-
-            if not data_frames:
-                print("No se han descargado datos intradiarios.")
-                result = pd.DataFrame()
-            else:
-                result = pd.concat(data_frames, ignore_index=True)
-                if "datetime" in result.columns:
-                    result.drop_duplicates(subset=["datetime"], keep='first', inplace=True)
-                    result.sort_values(by="datetime", inplace=True)
-
-            if save_csv:
-                filename = os.path.join(self.output_dir, f"{self.ticker}_{interval}.csv")
-                if os.path.isfile(filename):
-                    print(f"El archivo {filename} ya existe. Leyendo datos previos para concatenar...")
-                    try:
-                        existing_data = pd.read_csv(filename)
-                        existing_data = self.unify_columns(existing_data)
-                        result = pd.concat([existing_data, result], ignore_index=True)
-                        if "datetime" in result.columns:
-                            result.drop_duplicates(subset=["datetime"], keep='first', inplace=True)
-                            result.sort_values(by="datetime", inplace=True)
-                    except Exception as e:
-                        print(f"  Error al leer el archivo existente: {e}")
-                result.to_csv(filename, index=False, lineterminator='\n')
-                print(f"Datos guardados/acumulados en: {filename}")
-
-            return result
-
-        else:
-            # ----- Datos históricos (no intradiarios) -----
-            print(f"Descargando datos históricos para {self.ticker} | intervalo {interval}")
-            try:
-                df = yf.download(self.ticker, period="max", interval=interval, progress=False)
-                if not df.empty:
-                    df = self.flatten_columns(df)
-                    df.reset_index(inplace=True)
-                    # Renombrar columnas para unificar
-                    df.rename(columns={
-                        "Date": "datetime",
-                        "Open": "open",
-                        "High": "high",
-                        "Low": "low",
-                        "Close": "close",
-                        "Volume": "volume"
-                    }, inplace=True)
-                    if "Adj Close" in df.columns:
-                        df.drop(columns=["Adj Close"], inplace=True)
-                    df["datetime"] = pd.to_datetime(df["datetime"])
-                    df = df[["datetime", "open", "high", "low", "close", "volume"]]
-
-                    if save_csv:
-                        filename = os.path.join(self.output_dir, f"{self.ticker}_{interval}.csv")
-                        df.to_csv(filename, index=False, lineterminator='\n')
-                        print(f"  Datos guardados en: {filename}")
-
-                    return df
-                else:
-                    print(f"  No se han obtenido datos para el intervalo {interval}.")
-                    return pd.DataFrame()
-            except Exception as e:
-                print(f"  Error al descargar datos históricos para el intervalo {interval}: {e}")
-                return pd.DataFrame()
+        params = {key: value for key, value in (("historical_days", historical_days), ("chunk_days", chunk_days))
+                  if value is not None}
+        return self.download([interval], save_csv=save_csv, intraday_params={interval: params})[interval]
 
     def download(self, intervals, save_csv=True, intraday_params=None):
         """
-        Descarga datos para una lista de intervalos.
+        Descarga datos para una lista de intervalos con YahooBatchDownloader.
 
         :param intervals: Lista de intervalos deseados, por ejemplo: ["1d", "1wk", "1mo", "1m", "15m", ...]
         :param save_csv: Si True, guarda los datos en archivos CSV.
@@ -213,47 +288,40 @@ class UnifiedDataDownloader:
                                 ej: {"1m": {"historical_days": 30, "chunk_days": 8}, ...}
         :return: Diccionario con los intervalos como llaves y los DataFrames resultantes como valores.
         """
-        results = {}
-        for interval in intervals:
-            params = {}
-            if intraday_params and interval in intraday_params:
-                params = intraday_params[interval]
-            results[interval] = self.download_interval(interval, save_csv=save_csv, **params)
-        return results
+        windows = {interval: params for interval, params in (intraday_params or {}).items()
+                   if interval in self.intraday_intervals}
+        engine = YahooBatchDownloader()
+        engine.register(self.ticker, UnifiedDataDownloader(self.ticker, self.output_dir, save_csv), intervals, windows)
+        saved = engine.run()
+        if not save_csv:
+            return {interval: saved.get((self.ticker, interval), pd.DataFrame()) for interval in intervals}
+        # Los datos ya están en disco: el resultado de cada intervalo se lee de su CSV
+        return {interval: self.load_csv(interval) for interval in intervals}
+
 
 # ---------------------------------------------------------------------
 # Ejecución principal
 # ---------------------------------------------------------------------
 if __name__ == "__main__":
-    # 1. Cargar el fichero cryptos.txt (archivo JSON con lista de tickers)
-    with open("cryptos.txt", "r", encoding="utf-8") as f:
-        tickers = json.load(f)
+    # 1. Cargar el fichero cryptos.txt (un ticker por línea, ignorando líneas vacías o comentarios)
+    tickers = read_tickers("cryptos.txt")
 
     # 2. Definir intervalos a descargar:
     #    - Intervalos históricos (no intradiarios)
     historical_intervals = ["1d", "1wk", "1mo"]
-    #    - Intervalos intradiarios
-    intraday_intervals = ["1m", "2m", "5m", "15m", "30m", "60m", "90m", "1h"]
+    #    - Intervalos intradiarios (días históricos y por bloque según INTERVAL_CONFIG)
+    intraday_intervals = list(INTERVAL_CONFIG)
     # Combinar intervalos (ajusta según lo que necesites)
     intervals = historical_intervals + intraday_intervals
 
-    # 3. Opcional: parámetros específicos para datos intradiarios por intervalo
-    intraday_params = {
-        "1m": {"historical_days": 30, "chunk_days": 8},
-        "2m": {"historical_days": 30, "chunk_days": 15},
-        "5m": {"historical_days": 30, "chunk_days": 15},
-        "15m": {"historical_days": 30, "chunk_days": 15},
-        "30m": {"historical_days": 30, "chunk_days": 15},
-        "60m": {"historical_days": 90, "chunk_days": 15},
-        "90m": {"historical_days": 60, "chunk_days": 15},
-        "1h": {"historical_days": 90, "chunk_days": 15},
-    }
-
-    # 4. Procesar cada ticker
+    # 3. Registrar cada ticker en el motor de descarga, que agrupa las peticiones
+    #    de todos los tickers por intervalo y bloque
+    engine = YahooBatchDownloader()
     for ticker in tickers:
         # Generar directorio de salida basado en el ticker (por ejemplo, "BTC-USD" -> carpeta "btc")
         folder_name = ticker.split("-")[0].lower()
         output_directory = os.path.join(folder_name)
-        print(f"\nDescargando datos para {ticker} en carpeta: {output_directory}")
-        downloader = UnifiedDataDownloader(ticker, output_directory)
-        downloader.download(intervals, save_csv=True, intraday_params=intraday_params)
+        engine.register(ticker, UnifiedDataDownloader(ticker, output_directory), intervals)
+
+    # 4. Descargar todos los tickers
+    engine.run()
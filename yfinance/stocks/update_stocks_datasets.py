@@ -1,7 +1,93 @@
 #!/usr/bin/env python3
 import os
+import sys
+# Un hilo por proceso en las librerías numéricas: el paralelismo lo dan los procesos
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+import csv
 import pandas as pd
-import yfinance as yf
+
+# El motor de descarga común (yahoo_batch.py) está en el directorio yfinance/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from yahoo_batch import (SAVE_PARQUET, CsvWriter, YahooBatchDownloader, atomic_write, fast_ohlcv_to_csv,
+                         parse_csv_dates, read_tickers, restore_volume_dtype, write_parquet)
+
+
+class StockWriter(CsvWriter):
+    """
+    Guarda los datos descargados de una acción en "<carpeta>/<ticker>_<intervalo>.csv",
+    acumulándolos con los ya existentes.
+    """
+
+    def save(self, interval, data_frames):
+        """
+        Guarda (o acumula) en el CSV los datos descargados de un intervalo.
+
+        :param interval: Intervalo de los datos, ej: "1m", "1d".
+        :param data_frames: Lista de DataFrames descargados, con el índice temporal.
+        """
+        # Definir el archivo CSV de salida
+        output_file = self.csv_path(interval)
+        data = pd.concat(data_frames) if data_frames else pd.DataFrame()
+
+        if data.empty:
+            print(f"    No se han obtenido datos para {self.ticker} en el intervalo {interval}.")
+            return
+
+        # Nombre de la columna de fechas en el CSV ("Datetime" se guarda como "Date")
+        date_col = data.index.name if data.index.name not in (None, "Datetime") else "Date"
+
+        try:
+            # Si el archivo CSV ya existe, cargarlo y concatenar los nuevos datos
+            if os.path.exists(output_file):
+                # Convertir el índice en una columna con el nombre unificado
+                data = data.rename_axis(date_col).reset_index()
+                try:
+                    data_existente = pd.read_csv(output_file)
+                    # Las fechas se leen en UTC (el CSV mezcla desfases horarios por el horario
+                    # de verano) y se pasan a la zona horaria de los datos descargados
+                    data_existente[date_col] = parse_csv_dates(data_existente[date_col], utc=True).dt.tz_convert(
+                        data[date_col].dt.tz)
+                except Exception as e:
+                    # Reescribir el CSV solo con los datos nuevos perdería el histórico
+                    print(f"    Error al leer {output_file}: {e}. No se modifica el archivo.")
+                    return
+                # Concatenar los datos existentes con los nuevos
+                datos_combinados = pd.concat([data_existente, data])
+                # Eliminar duplicados basándose en la columna de fechas
+                datos_combinados.drop_duplicates(subset=date_col, keep="last", inplace=True)
+                # Ordenar los datos por fecha
+                datos_combinados.sort_values(date_col, inplace=True)
+                # Volumen como entero aunque el CSV existente lo tuviera como float
+                datos_combinados = restore_volume_dtype(datos_combinados)
+                with atomic_write(output_file, "w", buffering=1 << 20, newline="\n") as fh:
+                    fast_ohlcv_to_csv(datos_combinados, fh)
+            elif data.notna().all().all():
+                # Sin datos previos ni huecos: escribir las filas directamente desde el índice y
+                # las columnas, sin pasar por reset_index/rename/to_csv
+                with atomic_write(output_file, "w", buffering=1 << 20, newline="") as fh:
+                    writer = csv.writer(fh, lineterminator="\n")
+                    writer.writerow([date_col] + list(data.columns))
+                    writer.writerows(zip(data.index.astype(str), *(data[c].tolist() for c in data.columns)))
+                datos_combinados = None
+            else:
+                # Con valores nulos, to_csv los deja vacíos (csv.writer escribiría "nan")
+                with atomic_write(output_file, "w", buffering=1 << 20, newline="\n") as fh:
+                    data.rename_axis(date_col).to_csv(fh, lineterminator="\n")
+                datos_combinados = None
+            print(f"    Datos guardados en {output_file}")
+
+            # Copia en Parquet con todo el histórico del CSV
+            if SAVE_PARQUET:
+                if datos_combinados is None:
+                    datos_combinados = data.rename_axis(date_col).reset_index()
+                # Fechas en UTC: los CSV pueden mezclar desfases horarios (horario de verano)
+                datos_combinados[date_col] = pd.to_datetime(datos_combinados[date_col], utc=True)
+                parquet_file = os.path.splitext(output_file)[0] + ".parquet"
+                write_parquet(datos_combinados, parquet_file)
+                print(f"    Datos guardados en {parquet_file}")
+        except Exception as e:
+            print(f"    Error al guardar los datos en {output_file}: {e}")
+
 
 def main():
     # Lista de intervalos a descargar.
@@ -30,69 +116,30 @@ def main():
 
     # Leer el fichero stocks.txt y obtener los tickers (ignorando líneas vacías o comentarios)
     try:
-        with open("stocks.txt", "r") as f:
-            tickers = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+        tickers = read_tickers("stocks.txt")
     except FileNotFoundError:
         print("El fichero 'stocks.txt' no se ha encontrado.")
         return
 
-    # Procesar cada ticker
+    if not tickers:
+        return
+
+    # Registrar cada ticker en el motor de descarga. Se piden también dividendos y splits,
+    # y se conserva la zona horaria, como hace yf.Ticker.history. Cada ticker se pide por
+    # separado (group=ticker): en una petición conjunta yfinance pasaría todos los tickers
+    # a la zona horaria más común, desplazando las fechas de los mercados de otras zonas
+    engine = YahooBatchDownloader()
+    windows = {interval: {"period": periodo} for interval, periodo in periodos_por_intervalo.items()}
     for ticker in tickers:
-        print(f"\nProcesando {ticker} ...")
         # Crear carpeta para el ticker en el directorio actual
         folder = os.path.join(os.getcwd(), ticker)
-        os.makedirs(folder, exist_ok=True)
-
         # Para stocks no se añade sufijo; se usa el ticker tal cual
         ticker_yf = ticker
+        engine.register(ticker_yf, StockWriter(ticker, folder), intervals, windows, group=ticker_yf,
+                        actions=True, ignore_tz=False)
 
-        # Descargar y guardar datos para cada intervalo
-        for interval in intervals:
-            periodo = periodos_por_intervalo.get(interval, "max")
-            print(f"  Descargando datos en intervalo '{interval}' (period='{periodo}') para {ticker_yf}...")
-            try:
-                data = yf.Ticker(ticker_yf).history(interval=interval, period=periodo)
-            except Exception as e:
-                print(f"    Error al descargar {ticker_yf} para intervalo {interval}: {e}")
-                continue
-
-            if data.empty:
-                print(f"    No se han obtenido datos para {ticker_yf} en el intervalo {interval}.")
-                continue
-
-            # Convertir el índice en una columna y renombrarla si es necesario
-            data.reset_index(inplace=True)
-            if "Datetime" in data.columns:
-                data.rename(columns={"Datetime": "Date"}, inplace=True)
-            # Asegurarse de que la columna "Date" sea de tipo datetime
-            if "Date" in data.columns:
-                data["Date"] = pd.to_datetime(data["Date"])
-
-            # Definir el archivo CSV de salida
-            output_file = os.path.join(folder, f"{ticker}_{interval}.csv")
+    engine.run()
 
-            # Si el archivo CSV ya existe, cargarlo y concatenar los nuevos datos
-            if os.path.exists(output_file):
-                try:
-                    data_existente = pd.read_csv(output_file, parse_dates=["Date"])
-                except Exception as e:
-                    print(f"    Error al leer {output_file}: {e}")
-                    data_existente = pd.DataFrame()
-                # Concatenar los datos existentes con los nuevos
-                datos_combinados = pd.concat([data_existente, data])
-                # Eliminar duplicados basándose en la columna "Date"
-                datos_combinados.drop_duplicates(subset="Date", keep="last", inplace=True)
-                # Ordenar los datos por fecha
-                datos_combinados.sort_values("Date", inplace=True)
-            else:
-                datos_combinados = data
-
-            # Guardar los datos (combinados o nuevos) en el archivo CSV
-            try:
-                datos_combinados.to_csv(output_file, index=False)
-                print(f"    Datos guardados en {output_file}")
-            except Exception as e:
-                print(f"    Error al guardar los datos en {output_file}: {e}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Motor común de descarga por lotes desde Yahoo Finance, compartido por los scripts
+de cryptos/ y stocks/.
+
+Cada script registra sus tickers, los intervalos a descargar y el objeto que guarda
+los datos de cada ticker (YahooBatchDownloader.register). Al ejecutar el motor
+(YahooBatchDownloader.run), todas las ventanas de descarga iguales (intervalo y rango)
+se agrupan, se descargan con una única petición para todos sus tickers y el resultado
+se reparte por ticker.
+"""
+
+# pip install --upgrade yfinance
+
+import os
+import time
+import sqlite3
+import asyncio
+import multiprocessing
+from collections import Counter
+from contextlib import contextmanager, suppress
+from concurrent.futures import ProcessPoolExecutor
+import yfinance as yf
+import pandas as pd
+from datetime import timedelta
+from pathlib import Path
+from curl_cffi import requests as curl_requests
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es opcional: sin él solo se generan los CSV
+    pa = pq = None
+
+# Número máximo de descargas simultáneas contra Yahoo Finance
+MAX_CONCURRENT_DOWNLOADS = 16
+# Número máximo de intentos por petición (errores de red, rate limit 429, 5xx)
+MAX_RETRIES = 4
+# Solapamiento con el último dato guardado al actualizar un CSV existente
+INCREMENTAL_OVERLAP = timedelta(hours=2)
+# Generar también una copia en Parquet (zstd) de cada CSV, si pyarrow está instalado
+SAVE_PARQUET = pa is not None
+# Caché local de bloques intradiarios ya descargados (requiere pyarrow), para que relanzar
+# el script tras un fallo parcial no repita las descargas
+CHUNK_CACHE_PATH = ".yf_cache.db" if pa is not None else None
+# Antigüedad a partir de la cual se eliminan los bloques de la caché
+CHUNK_CACHE_MAX_AGE = timedelta(days=60)
+# Intervalos intradiarios reconocidos, con sus valores por defecto para la descarga
+# en bloques: (días históricos, días por bloque)
+INTERVAL_CONFIG = {
+    "1m": (30, 8),
+    "2m": (30, 15),
+    "5m": (30, 15),
+    "15m": (30, 15),
+    "30m": (30, 15),
+    "60m": (90, 15),
+    "90m": (60, 15),
+    "1h": (90, 15),
+}
+INTRADAY_INTERVALS = set(INTERVAL_CONFIG)
+# Formatos de fecha de los CSV: con desfase horario (stocks), con hora (intradiarios) y solo fecha
+CSV_DATE_FORMATS = ("%Y-%m-%d %H:%M:%S%z", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+
+def read_tickers(path):
+    """
+    Lee un fichero de tickers con uno por línea, ignorando las líneas vacías y los comentarios (#).
+
+    :param path: Ruta del fichero, por ejemplo "stocks.txt".
+    :return: Lista de tickers.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def new_session():
+    """
+    Crea una sesión HTTP para compartir entre todas las llamadas a yfinance, de modo que se
+    reutilicen las conexiones (keep-alive, sin repetir el handshake TLS) y las cookies de Yahoo.
+    """
+    return curl_requests.Session(impersonate="chrome")
+
+
+def fetch_with_retry(func, *args, **kwargs):
+    """
+    Ejecuta una llamada de descarga reintentando con back-off exponencial
+    (0.5s, 1s, 2s, ...) cuando se produce una excepción.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            wait = 2 ** attempt * 0.5
+            print(f"  Error en la descarga ({e}). Reintentando en {wait:.1f}s...")
+            time.sleep(wait)
+
+
+def parse_csv_dates(values, utc=False):
+    """
+    Convierte las fechas leídas de un CSV con el primero de CSV_DATE_FORMATS que encaje.
+    Con el formato explícito pandas no tiene que deducirlo fila a fila. Si ninguno encaja
+    (p. ej. fechas con fracciones de segundo), se prueba con cualquier fecha ISO 8601.
+
+    :param values: Cadena o serie de cadenas con las fechas.
+    :param utc: Si True, las fechas se devuelven en UTC (necesario si mezclan desfases
+                horarios, p. ej. por el horario de verano).
+    :return: pd.Timestamp o serie de fechas.
+    """
+    for fmt in CSV_DATE_FORMATS:
+        try:
+            return pd.to_datetime(values, format=fmt, utc=utc, cache=True)
+        except ValueError:
+            continue
+    try:
+        return pd.to_datetime(values, format="ISO8601", utc=utc)
+    except ValueError as e:
+        raise ValueError("Formato de fecha no reconocido") from e
+
+
+def read_last_timestamp(filename):
+    """
+    Devuelve la fecha de la última fila de un CSV leyendo solo el final del fichero.
+
+    :return: pd.Timestamp, o None si el fichero no existe o solo tiene la cabecera.
+    :raises ValueError: Si la última fila no tiene una fecha válida.
+    """
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, "rb") as fh:
+        fh.seek(0, os.SEEK_END)
+        start = max(0, fh.tell() - 1024)
+        fh.seek(start)
+        # Las líneas en blanco del final no son filas de datos
+        lines = [line for line in fh.read().splitlines() if line.strip()]
+    # Sin filas de datos: fichero vacío o solo con la cabecera
+    if not lines or (start == 0 and len(lines) == 1):
+        return None
+    last_ts = parse_csv_dates(lines[-1].decode("utf-8").split(",", 1)[0])
+    if pd.isna(last_ts):
+        raise ValueError(f"La última fila de {filename} no tiene fecha")
+    return last_ts
+
+
+@contextmanager
+def atomic_write(path, mode="w", **kwargs):
+    """
+    Abre para escritura un fichero temporal junto a path y, si todo se escribe sin errores,
+    lo mueve sobre path con os.replace (atómico dentro del mismo sistema de ficheros).
+    Los lectores nunca ven un fichero a medio escribir; si hay un error, el temporal se elimina.
+
+    :param path: Ruta del fichero de destino.
+    :param mode: Modo de apertura ("w" o "wb").
+    :param kwargs: Resto de argumentos de open (buffering, newline, ...).
+    """
+    directory, name = os.path.split(path)
+    # Temporal oculto: los lectores de datasets Parquet ignoran los ficheros que empiezan por "."
+    tmp = os.path.join(directory, f".{name}.tmp")
+    try:
+        with open(tmp, mode, **kwargs) as fh:
+            yield fh
+        os.replace(tmp, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+def write_parquet(df, path):
+    """
+    Guarda un DataFrame (sin índice) en formato Parquet con compresión zstd.
+    """
+    # Enteros siempre como int64: los bloques de un mismo dataset deben compartir esquema
+    # aunque en memoria el volumen se haya reducido a un tipo más pequeño
+    df = df.astype({col: "int64" for col in df.columns if pd.api.types.is_integer_dtype(df[col])})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with atomic_write(path, "wb") as fh:
+        pq.write_table(table, fh, compression="zstd", compression_level=3)
+
+
+def concat_frames(data_frames):
+    """
+    Une una secuencia de DataFrames (sin índice) con las mismas columnas. Si pyarrow está
+    instalado, cada DataFrame se añade a un stream IPC en memoria según llega, en lugar de
+    acumularlos todos en una lista y copiarlos de nuevo con pd.concat.
+
+    :param data_frames: Iterable de DataFrames, por ejemplo un generador de bloques.
+    :return: DataFrame con todas las filas (vacío si no hay ninguna).
+    """
+    if pa is None:
+        data_frames = list(data_frames)
+        return pd.concat(data_frames, ignore_index=True) if data_frames else pd.DataFrame()
+
+    # Un stream IPC exige el mismo esquema en todos los bloques. Cada bloque se adapta al
+    # esquema del stream en curso (p. ej. un volumen float con nulos pasa a entero con nulos);
+    # si no es posible, se abre otro stream y al final se unen promocionando los tipos
+    segments = []  # [(sink, writer, esquema)]
+    for df in data_frames:
+        # Enteros como int64 para que los bloques coincidan aunque el volumen se haya reducido
+        df = df.astype({col: "int64" for col in df.columns if pd.api.types.is_integer_dtype(df[col])})
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if segments and not table.schema.equals(segments[-1][2]):
+            with suppress(pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                table = table.cast(segments[-1][2])
+        if not segments or not table.schema.equals(segments[-1][2]):
+            sink = pa.BufferOutputStream()
+            segments.append((sink, pa.ipc.new_stream(sink, table.schema), table.schema))
+        segments[-1][1].write_table(table)
+    if not segments:
+        return pd.DataFrame()
+
+    tables = []
+    for sink, writer, _ in segments:
+        writer.close()
+        tables.append(pa.ipc.open_stream(sink.getvalue()).read_all())
+    return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+
+def fast_ohlcv_to_csv(df, fh, header=True):
+    """
+    Escribe un DataFrame OHLCV (sin índice) en un fichero de texto ya abierto, formateando
+    cada fila directamente en lugar de pasar por el formateador CSV genérico de pandas.
+    El resultado es idéntico a df.to_csv(fh, index=False, lineterminator='\\n').
+
+    Solo se aplica si la primera columna es de fechas y el resto son numéricas sin nulos;
+    en cualquier otro caso se recurre a df.to_csv.
+    """
+    date_col, value_cols = df.columns[0], df.columns[1:]
+    fmt = "%s"
+    for col in value_cols:
+        if pd.api.types.is_integer_dtype(df[col]):
+            fmt += ",%d"
+        elif pd.api.types.is_float_dtype(df[col]):
+            fmt += ",%r"
+        else:
+            fmt = None
+            break
+    if (fmt is None or df.empty or not pd.api.types.is_datetime64_any_dtype(df[date_col])
+            or df.isna().any().any()):
+        df.to_csv(fh, index=False, header=header, lineterminator='\n')
+        return
+
+    fmt += "\n"
+    if header:
+        fh.write(",".join(df.columns) + "\n")
+    dates = df[date_col].astype(str).tolist()
+    values = [df[col].tolist() for col in value_cols]
+    fh.writelines(fmt % row for row in zip(dates, *values))
+
+
+def compute_chunks(interval, historical_days=None, chunk_days=None, since=None):
+    """
+    Calcula los bloques (inicio, fin) en los que se descarga un intervalo intradiario.
+
+    :param interval: Intervalo intradiario, ej: "1m", "15m", etc.
+    :param historical_days: Número total de días históricos a descargar (por defecto, el de INTERVAL_CONFIG).
+    :param chunk_days: Número de días por bloque de descarga (por defecto, el de INTERVAL_CONFIG).
+    :param since: Fecha opcional desde la que descargar (actualización incremental);
+                  nunca anterior al inicio de la ventana de historical_days.
+    :return: Lista de tuplas (inicio, fin) como pd.Timestamp.
+    """
+    # Definir valores por defecto si no se especifican
+    default_hd, default_chunk = INTERVAL_CONFIG.get(interval, (30, 15))
+    if historical_days is None:
+        historical_days = default_hd
+    if chunk_days is None:
+        chunk_days = default_chunk
+
+    now = pd.Timestamp.now()
+    end_date = now
+    start_date = now - timedelta(days=historical_days) + timedelta(days=1)
+    if since is not None:
+        start_date = max(start_date, since)
+
+    # Fronteras de los bloques calculadas de una vez (a medianoche, que es la precisión
+    # con la que se piden a yfinance); el último bloque se recorta a la fecha actual.
+    # Un bloque que empezase hoy se pediría con inicio y fin iguales, así que se omite
+    edges = pd.date_range(start_date.normalize(), end_date.normalize() + timedelta(days=chunk_days),
+                          freq=f"{chunk_days}D")
+    return [(current_start, min(current_end, end_date))
+            for current_start, current_end in zip(edges[:-1], edges[1:])
+            if current_start < end_date.normalize()]
+
+
+def contiguous_frames(data_frames, has_previous=False):
+    """
+    Recorta una secuencia de bloques en orden cronológico en el primer bloque sin datos
+    (None) que deje un hueco: tras el último dato ya guardado o entre bloques con datos.
+    Como los CSV intradiarios se actualizan añadiendo lo posterior a su última fila, guardar
+    los bloques siguientes dejaría ese hueco para siempre; sin ellos, la próxima ejecución
+    vuelve a pedir desde el hueco.
+
+    :param data_frames: Iterable de DataFrames, con None en los bloques sin datos o con error.
+    :param has_previous: True si ya hay datos guardados antes del primer bloque.
+    :return: Generador con los DataFrames hasta el primer hueco.
+    """
+    seen = has_previous
+    for df in data_frames:
+        if df is None:
+            if seen:
+                print("  Bloque sin datos: se guarda hasta ese punto y el resto se pedirá "
+                      "de nuevo en la próxima ejecución.")
+                return
+            continue
+        seen = True
+        yield df
+
+
+def download_batch(tickers, interval, session=None, **kwargs):
+    """
+    Descarga en una sola petición los datos de todos los tickers para un intervalo.
+
+    yf.download captura los errores de cada ticker (incluidos los rate limit 429) y devuelve
+    un DataFrame vacío para él, así que los tickers que vuelven sin datos se piden de nuevo,
+    solo ellos, con back-off exponencial (0.5s, 1s, 2s, ...).
+
+    :param tickers: Lista de tickers, por ejemplo ["BTC-USD", "ETH-USD"].
+    :param interval: Intervalo de datos, ej: "1d", "1m", etc.
+    :param session: Sesión HTTP opcional (ver new_session) para reutilizar entre descargas.
+    :param kwargs: Rango a descargar (start/end o period) y otras opciones de yf.download.
+    :return: Diccionario {ticker: DataFrame} con los tickers que tienen datos.
+    """
+    frames = {}
+    pending = list(tickers)
+    for attempt in range(MAX_RETRIES):
+        batch = fetch_with_retry(
+            yf.download,
+            " ".join(pending),
+            interval=interval,
+            group_by='ticker',
+            threads=True,
+            progress=False,
+            session=session,
+            **kwargs
+        )
+        for ticker in pending:
+            df = split_ticker(batch, ticker)
+            if not df.empty:
+                frames[ticker] = df
+        pending = [ticker for ticker in pending if ticker not in frames]
+        if not pending or attempt == MAX_RETRIES - 1:
+            break
+        wait = 2 ** attempt * 0.5
+        print(f"  Sin datos para {len(pending)} tickers | intervalo {interval}. Reintentando en {wait:.1f}s...")
+        time.sleep(wait)
+    return frames
+
+
+def restore_volume_dtype(df):
+    """
+    Devuelve la columna Volume a enteros si no tiene nulos. En una descarga multi-ticker,
+    yfinance alinea todos los tickers sobre la unión de sus fechas y los huecos rellenos con
+    NaN convierten el volumen en float, aunque luego se descarten esas filas.
+    """
+    if "Volume" in df.columns and pd.api.types.is_float_dtype(df["Volume"]) and df["Volume"].notna().all():
+        df = df.astype({"Volume": "int64"})
+    return df
+
+
+def split_ticker(batch, ticker):
+    """
+    Extrae de una descarga multi-ticker (group_by='ticker') los datos de un ticker.
+    yf.download devuelve los símbolos en mayúsculas, así que se buscan en mayúsculas.
+    """
+    ticker = ticker.upper()
+    if batch is None or batch.empty or ticker not in batch.columns.get_level_values(0):
+        return pd.DataFrame()
+    return restore_volume_dtype(batch[ticker].dropna(how='all'))
+
+
+class ChunkCache:
+    """
+    Caché en SQLite de los bloques intradiarios descargados, indexada por
+    (ticker, intervalo, inicio, fin). Cada bloque se guarda tal y como se descargó,
+    serializado en Parquet.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Ruta del fichero SQLite de la caché.
+        """
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "ticker TEXT, interval TEXT, chunk_start TEXT, chunk_end TEXT, created TEXT, payload BLOB, "
+                "PRIMARY KEY (ticker, interval, chunk_start, chunk_end))"
+            )
+            # Purgar bloques antiguos: sus rangos ya no se vuelven a pedir
+            oldest = (pd.Timestamp.now() - CHUNK_CACHE_MAX_AGE).isoformat()
+            self.conn.execute("DELETE FROM chunks WHERE created < ?", (oldest,))
+
+    def get(self, ticker, interval, start, end):
+        """
+        Devuelve el bloque guardado, o None si no está en la caché.
+        """
+        row = self.conn.execute(
+            "SELECT payload FROM chunks WHERE ticker = ? AND interval = ? AND chunk_start = ? AND chunk_end = ?",
+            (ticker, interval, start, end)
+        ).fetchone()
+        if row is None:
+            return None
+        return pq.read_table(pa.BufferReader(row[0])).to_pandas()
+
+    def put(self, ticker, interval, start, end, df):
+        """
+        Guarda un bloque descargado (con su índice temporal).
+        """
+        sink = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pandas(df), sink, compression="zstd")
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+                (ticker, interval, start, end, pd.Timestamp.now().isoformat(), sink.getvalue().to_pybytes())
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class CsvWriter:
+    """
+    Base de los writers que guardan cada intervalo de un ticker en
+    "<directorio>/<ticker>_<intervalo>.csv", ordenado por fecha.
+    """
+
+    def __init__(self, ticker, output_dir):
+        """
+        :param ticker: Símbolo del activo, por ejemplo "BTC-USD".
+        :param output_dir: Directorio donde se guardarán los archivos CSV.
+        """
+        self.ticker = ticker
+        self.output_dir = output_dir
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+
+    def csv_path(self, interval):
+        """
+        Ruta del CSV de un intervalo.
+        """
+        return os.path.join(self.output_dir, f"{self.ticker}_{interval}.csv")
+
+    def incremental_start(self, interval):
+        """
+        Fecha desde la que hay que descargar para completar el CSV existente
+        (el último dato menos INCREMENTAL_OVERLAP), o None si no hay CSV previo.
+        Si el CSV no se puede leer también devuelve None: se descarga la ventana
+        completa y es save quien decide qué hacer con el fichero.
+        """
+        try:
+            last_ts = read_last_timestamp(self.csv_path(interval))
+        except (OSError, ValueError):
+            return None
+        if last_ts is None:
+            return None
+        return last_ts - INCREMENTAL_OVERLAP
+
+
+class YahooBatchDownloader:
+    """
+    Motor de descarga por lotes para todos los tickers registrados.
+
+    Cada registro indica, por intervalo, la ventana a descargar:
+      - {"period": "60d"}: una única petición con ese periodo (o desde el último dato
+        guardado, si está dentro del periodo). Con "max" se descarga siempre todo.
+      - {"historical_days": 30, "chunk_days": 8}: descarga en bloques (ver compute_chunks),
+        desde el último dato guardado si lo hay. Ambos valores son opcionales.
+
+    Los tickers con el mismo intervalo, ventana, opciones de descarga y etiqueta forman un grupo:
+    cada bloque del grupo se pide una sola vez para todos ellos. La escritura de cada
+    ticker se reparte entre varios procesos.
+
+    El objeto que guarda los datos de cada ticker (writer, normalmente un CsvWriter) debe
+    poder enviarse a otro proceso y ofrecer:
+      - writer.incremental_start(interval): fecha desde la que completar los datos ya
+        guardados, o None si no hay datos previos.
+      - writer.save(interval, data_frames): guarda la lista de DataFrames descargados
+        (uno por bloque, en orden cronológico, con el índice temporal). La lista se corta
+        en el primer bloque que falte (ver contiguous_frames), para no dejar huecos.
+        Lo que devuelva se recoge en el resultado de run.
+    """
+
+    def __init__(self):
+        # {(intervalo, ventana, opciones de descarga, etiqueta): [(ticker, writer), ...]}
+        self.groups = {}
+
+    def register(self, ticker, writer, intervals, windows=None, group=None, **download_kwargs):
+        """
+        Registra un ticker para descargar.
+
+        :param ticker: Ticker en Yahoo Finance, por ejemplo "BTC-USD" o "AAPL".
+        :param writer: Objeto que guarda los datos del ticker (ver la documentación de la clase).
+        :param intervals: Lista de intervalos a descargar, ej: ["1d", "1m", "15m"].
+        :param windows: Diccionario opcional con la ventana de cada intervalo, ej:
+                        {"1m": {"historical_days": 30, "chunk_days": 8}, "1d": {"period": "max"}}.
+                        Por defecto, los intradiarios se descargan en bloques y el resto con period="max".
+        :param group: Etiqueta opcional: solo se piden juntos los tickers con la misma etiqueta
+                      (además del mismo intervalo, ventana y opciones). Con el propio ticker
+                      como etiqueta, cada ticker se pide por separado.
+        :param download_kwargs: Opciones adicionales de yf.download, ej: actions=True.
+        """
+        for interval in intervals:
+            window = (windows or {}).get(interval)
+            if window is None:
+                window = {} if interval in INTRADAY_INTERVALS else {"period": "max"}
+            key = (interval, tuple(sorted(window.items())), tuple(sorted(download_kwargs.items())), group)
+            self.groups.setdefault(key, []).append((ticker, writer))
+
+    @staticmethod
+    def ranges(interval, window, members):
+        """
+        Calcula los rangos que hay que pedir para un grupo de tickers.
+
+        :param interval: Intervalo del grupo.
+        :param window: Ventana del grupo (ver la documentación de la clase).
+        :param members: Lista de (ticker, writer) del grupo.
+        :return: Lista de diccionarios con el rango de cada petición (start/end, start o period).
+        """
+        # Actualización incremental: si todos los tickers tienen datos previos, basta con
+        # descargar desde el último dato más antiguo de entre todos ellos
+        starts = [writer.incremental_start(interval) for _, writer in members]
+        since = min(starts) if all(start is not None for start in starts) else None
+
+        if "period" in window:
+            period = window["period"]
+            if since is not None and period != "max" and since > pd.Timestamp.now(tz=since.tz) - pd.Timedelta(period):
+                return [{"start": since.strftime("%Y-%m-%d")}]
+            return [{"period": period}]
+
+        return [{"start": current_start.strftime("%Y-%m-%d"), "end": current_end.strftime("%Y-%m-%d")}
+                for current_start, current_end in compute_chunks(interval, since=since, **window)]
+
+    def run(self):
+        """
+        Descarga y guarda todos los tickers registrados.
+
+        :return: Diccionario {(ticker, intervalo): valor devuelto por writer.save}, sin
+                 los intervalos que no se pudieron guardar.
+        """
+        return asyncio.run(self.download_all())
+
+    async def download_all(self):
+        """
+        Descarga todos los grupos. Las peticiones se ejecutan en hilos (yfinance es síncrono)
+        y el número de peticiones simultáneas se limita con un semáforo a MAX_CONCURRENT_DOWNLOADS.
+
+        :return: Lo mismo que run.
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        # Una única sesión HTTP para todas las peticiones (los writers se envían a otros
+        # procesos para escribir, así que no la guardan)
+        session = new_session()
+        ranges = {key: self.ranges(key[0], dict(key[1]), members) for key, members in self.groups.items()}
+        # La caché solo guarda bloques cerrados (con fecha de fin): sin ellos no se abre
+        bounded = any("end" in rango for group_ranges in ranges.values() for rango in group_ranges)
+        cache = ChunkCache(CHUNK_CACHE_PATH) if CHUNK_CACHE_PATH and bounded else None
+
+        async def fetch(interval, tickers, rango, download_kwargs):
+            """
+            Obtiene un rango para todos los tickers del grupo: los bloques que están en la caché
+            se leen de ella y el resto se descarga en una única petición.
+
+            :return: Diccionario {ticker: DataFrame} con los tickers que tienen datos.
+            """
+            # Solo se guardan en la caché los bloques cerrados (con fecha de fin)
+            cacheable = cache is not None and "end" in rango
+            frames = {}
+            if cacheable:
+                for ticker in tickers:
+                    df = cache.get(ticker, interval, rango["start"], rango["end"])
+                    if df is not None:
+                        frames[ticker] = restore_volume_dtype(df)
+            missing = [ticker for ticker in tickers if ticker not in frames]
+            if not missing:
+                return frames
+
+            print(f"Descargando {len(missing)} tickers | intervalo {interval} "
+                  f"({', '.join(f'{k}={v}' for k, v in rango.items())})")
+            async with semaphore:
+                try:
+                    downloaded = await asyncio.to_thread(download_batch, missing, interval, session=session,
+                                                         **rango, **download_kwargs)
+                except Exception as e:
+                    print(f"  Error descargando el intervalo {interval} ({rango}): {e}")
+                    return frames
+            for ticker, df in downloaded.items():
+                frames[ticker] = df
+                if cacheable:
+                    cache.put(ticker, interval, rango["start"], rango["end"], df)
+            return frames
+
+        loop = asyncio.get_running_loop()
+        # Intervalos pendientes de guardar por ticker, para informar del progreso por ticker
+        pending = Counter(ticker for members in self.groups.values() for ticker, _ in members)
+        failed = set()
+        completed = 0
+        results = {}
+        # Los procesos no se crean con fork: se arrancan mientras hay hilos descargando, y un
+        # fork podría heredar un lock tomado por alguno de ellos y bloquearse
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        executor = ProcessPoolExecutor(max_workers=max(1, min(os.cpu_count() or 1, len(pending))),
+                                       mp_context=multiprocessing.get_context(start_method))
+
+        async def save(ticker, writer, interval, data_frames):
+            # Un error al guardar un ticker no afecta a los demás
+            try:
+                results[ticker, interval] = await loop.run_in_executor(executor, writer.save, interval, data_frames)
+            except Exception as e:
+                print(f"  Error guardando {ticker} | intervalo {interval}: {e}")
+                failed.add(ticker)
+            return ticker
+
+        async def process_group(key, members):
+            nonlocal completed
+            interval, _, download_kwargs, _ = key
+            group_tickers = list(dict.fromkeys(ticker for ticker, _ in members))
+            download_kwargs = dict(download_kwargs)
+            rango_frames = await asyncio.gather(*(
+                fetch(interval, group_tickers, rango, download_kwargs) for rango in ranges[key]
+            ))
+            saves = [
+                save(ticker, writer, interval, list(contiguous_frames(
+                    (frames.get(ticker) for frames in rango_frames),
+                    has_previous=writer.incremental_start(interval) is not None)))
+                for ticker, writer in members
+            ]
+            for finished in asyncio.as_completed(saves):
+                ticker = await finished
+                pending[ticker] -= 1
+                if pending[ticker] == 0:
+                    completed += 1
+                    status = "completado con errores" if ticker in failed else "completado"
+                    print(f"[{completed}/{len(pending)}] {ticker} {status}.")
+
+        try:
+            with executor:
+                await asyncio.gather(*(process_group(key, members) for key, members in self.groups.items()))
+        finally:
+            if cache is not None:
+                cache.close()
+        return results